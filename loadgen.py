@@ -0,0 +1,422 @@
+# Replays recorded authorizer events through lambda_handler against local fakes of the AWS clients.
+#
+# Example:
+#
+#   aws apigateway get-api-keys --include-values > keys.json
+#   python loadgen.py events.jsonl --api-keys keys.json --repeat 100 --processes 4
+#
+import argparse
+import bisect
+import functools
+import gc
+import itertools
+import json
+import multiprocessing
+import multiprocessing.util
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+import main
+
+# Latency histogram bucket upper bounds in seconds, growing by 25% from 10us to about 10s
+HISTOGRAM_BOUNDS = [0.00001 * (1.25 ** i) for i in range(63)]
+
+TIER_MEMORY = "memory"
+
+TIER_DYNAMODB = "dynamodb"
+
+TIER_GET_API_KEYS = "get_api_keys"
+
+TIER_NONE = "none"
+
+TIER_ERROR = "error"
+
+# Fake DynamoDB tables to use when the corresponding environment variables are not set
+DEFAULT_CACHE_TABLE_NAME = "cache"
+
+DEFAULT_USAGE_COUNTER_TABLE_NAME = "usage"
+
+
+class Histogram:
+    """ A fixed-size latency histogram, so recording samples does not itself grow memory """
+
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.total = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(HISTOGRAM_BOUNDS, seconds)] += 1
+        self.total += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        for (i, count) in enumerate(other.counts):
+            self.counts[i] += count
+        self.total += other.total
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        """ Returns the upper bound of the bucket containing the given percentile, capped at the maximum, in seconds """
+
+        if self.total == 0:
+            return 0.0
+        rank = p / 100.0 * self.total
+        seen = 0
+        for (i, count) in enumerate(self.counts):
+            seen += count
+            if count > 0 and seen >= rank:
+                return min(HISTOGRAM_BOUNDS[i], self.max) if i < len(HISTOGRAM_BOUNDS) else self.max
+        return self.max
+
+    def mean(self):
+        return self.sum / self.total if self.total > 0 else 0.0
+
+
+def sleep_ms(ms):
+    if ms > 0:
+        time.sleep(ms / 1000.0)
+
+
+class FakePaginator:
+    """ Serves get_api_keys pages from a local list of API keys """
+
+    def __init__(self, api_keys, latency_ms):
+        self.api_keys = api_keys
+        self.latency_ms = latency_ms
+
+    def paginate(self, **kwargs):
+        page_size = kwargs.get("PaginationConfig", {}).get("PageSize", 25)
+        name_query = kwargs.get("nameQuery")
+        customer_id = kwargs.get("customerId")
+
+        items = self.api_keys
+        if name_query is not None:
+            items = [item for item in items if item.get("name", "").startswith(name_query)]
+        if customer_id is not None:
+            items = [item for item in items if item.get("customerId") == customer_id]
+
+        for offset in range(0, max(len(items), 1), page_size):
+            sleep_ms(self.latency_ms)
+            yield {
+                "items": items[offset:offset + page_size]
+            }
+
+
+class FakeApiGatewayClient:
+    """ Stands in for the boto3 API Gateway client """
+
+    def __init__(self, api_keys, latency_ms=0):
+        self.api_keys = api_keys
+        self.latency_ms = latency_ms
+
+    def get_paginator(self, operation_name):
+        if operation_name != "get_api_keys":
+            raise ValueError("Unsupported operation: " + operation_name)
+        return FakePaginator(self.api_keys, self.latency_ms)
+
+
+class FakeDynamoDbClient:
+    """ Stands in for the boto3 DynamoDB client with one in-memory dict per table """
+
+    def __init__(self, latency_ms=0):
+        self.latency_ms = latency_ms
+        self.tables = {}
+
+    def get_item(self, TableName, Key):
+        sleep_ms(self.latency_ms)
+        ((_, key),) = Key.items()
+        item = self.tables.get(TableName, {}).get(key["S"])
+        return {"Item": item} if item is not None else {}
+
+    def put_item(self, TableName, Item):
+        sleep_ms(self.latency_ms)
+        self.tables.setdefault(TableName, {})[Item["value"]["S"]] = Item
+        return {}
+
+    def update_item(self, TableName, Key, ExpressionAttributeValues, **kwargs):
+        sleep_ms(self.latency_ms)
+        ((_, key),) = Key.items()
+        item = self.tables.setdefault(TableName, {}).setdefault(key["S"], {"count": 0})
+        item["count"] += int(ExpressionAttributeValues[":count"]["N"])
+        return {}
+
+
+# The cache tier that served the most recent lambda_handler call in this process
+current_tier = None
+
+
+def instrument(api_keys, get_api_keys_latency_ms, dynamodb_latency_ms, authorizer_output=os.devnull):
+    """ Point main at local fakes and record which cache tier serves each request """
+
+    # Keep the authorizer's log lines, e.g., EMF usage counts, out of the report
+    main.print = functools.partial(print, file=open(authorizer_output, "a", buffering=1))
+
+    main.api_gateway_client = FakeApiGatewayClient(api_keys, get_api_keys_latency_ms)
+    main.dynamodb_client = FakeDynamoDbClient(dynamodb_latency_ms)
+
+    # Cache entries and usage counters are keyed differently, so keep them in separate fake tables
+    if main.CACHE_TABLE_NAME is None:
+        main.CACHE_TABLE_NAME = DEFAULT_CACHE_TABLE_NAME
+    if main.USAGE_COUNTER_TABLE_NAME is None:
+        main.USAGE_COUNTER_TABLE_NAME = DEFAULT_USAGE_COUNTER_TABLE_NAME
+
+    get_api_key_memory_cache_entry = main.get_api_key_memory_cache_entry
+    get_api_key_cache_entry = main.get_api_key_cache_entry
+    fetch_api_key = main.fetch_api_key
+
+    def instrumented_get_api_key_memory_cache_entry(value, now=None):
+        global current_tier
+        result = get_api_key_memory_cache_entry(value, now)
+        if result is not None:
+            current_tier = TIER_MEMORY
+        return result
+
+    def instrumented_get_api_key_cache_entry(value, now=None):
+        global current_tier
+        result = get_api_key_cache_entry(value, now)
+        if result is not None:
+            current_tier = TIER_DYNAMODB
+        return result
+
+    def instrumented_fetch_api_key(value):
+        global current_tier
+        current_tier = TIER_GET_API_KEYS
+        return fetch_api_key(value)
+
+    main.get_api_key_memory_cache_entry = instrumented_get_api_key_memory_cache_entry
+    main.get_api_key_cache_entry = instrumented_get_api_key_cache_entry
+    main.fetch_api_key = instrumented_fetch_api_key
+
+
+def replay(events):
+    """ Run the given events through lambda_handler, returning latency histograms by cache tier
+
+    Denials are counted under their cache tier, and any other exception is counted under the error tier.
+    """
+
+    global current_tier
+
+    histograms = {}
+    for event in events:
+        current_tier = None
+        start = time.perf_counter()
+        tier = None
+        try:
+            main.lambda_handler(event, None)
+            authorized = True
+        except Exception as e:
+            if str(e) != "Unauthorized":
+                tier = TIER_ERROR
+            authorized = False
+        elapsed = time.perf_counter() - start
+        if tier is None:
+            tier = current_tier or TIER_NONE
+            if not authorized:
+                tier = tier + " denied"
+        histograms.setdefault(tier, Histogram()).record(elapsed)
+    return histograms
+
+
+def flush_usage_counters():
+    """ Write all usage counts still pending, as the last invocations of a container would """
+
+    while len(main.usage_counters) > 0:
+        pending = len(main.usage_counters)
+        main.flush_usage_counters()
+
+        # A failed flush writes nothing, so stop rather than retrying forever
+        if len(main.usage_counters) >= pending:
+            break
+
+
+def sample_memory():
+    """ Returns a snapshot of this process's memory, API key memory cache, and garbage collector state """
+
+    # Prefer current RSS where /proc is available, and fall back to peak RSS elsewhere
+    try:
+        with open("/proc/self/statm") as f:
+            rss_bytes = int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        rss_bytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+    return {
+        "rss_bytes": rss_bytes,
+        "traced_bytes": tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None,
+        "cache_entries": len(main.api_key_memory_cache),
+        "cache_bytes": main.api_key_memory_cache_stats["bytes"],
+        "cache_evictions": main.api_key_memory_cache_stats["evictions"],
+        "gc_collections": [s["collections"] for s in gc.get_stats()]
+    }
+
+
+def read_events(paths, repeat):
+    """ Stream authorizer events from the given JSON Lines files, repeating the files as requested """
+
+    for _ in range(repeat):
+        for path in paths:
+            with open(path) as f:
+                for line in f:
+                    line = line.strip()
+                    if line != "":
+                        yield json.loads(line)
+
+
+def read_api_keys(path):
+    """ Read API keys in the format printed by `aws apigateway get-api-keys --include-values` """
+
+    if path is None:
+        return []
+    with open(path) as f:
+        api_keys = json.load(f)
+    if isinstance(api_keys, dict):
+        api_keys = api_keys.get("items", [])
+    return api_keys
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+def init_worker(api_keys, get_api_keys_latency_ms, dynamodb_latency_ms, authorizer_output, trace_memory):
+    if trace_memory:
+        tracemalloc.start()
+    instrument(api_keys, get_api_keys_latency_ms, dynamodb_latency_ms, authorizer_output)
+
+    # Runs when the worker exits after the pool is closed
+    multiprocessing.util.Finalize(None, flush_usage_counters, exitpriority=10)
+
+
+def run_chunk(events):
+    histograms = replay(events)
+    return (histograms, multiprocessing.current_process().name, sample_memory())
+
+
+def format_bytes(n):
+    if n is None:
+        return "-"
+    return f"{n / (1024 * 1024):.1f}MiB"
+
+
+def print_memory_sample(completed, worker, sample, out):
+    print(
+        f"memory events={completed} worker={worker} rss={format_bytes(sample['rss_bytes'])}"
+        f" traced={format_bytes(sample['traced_bytes'])}"
+        f" cache={sample['cache_entries']}/{format_bytes(sample['cache_bytes'])}"
+        f" evictions={sample['cache_evictions']}"
+        f" gc={'/'.join(str(c) for c in sample['gc_collections'])}",
+        file=out)
+
+
+def print_report(histograms, elapsed, out):
+    total = Histogram()
+    for histogram in histograms.values():
+        total.merge(histogram)
+
+    throughput = total.total / elapsed if elapsed > 0 else 0.0
+    print(f"events={total.total} elapsed={elapsed:.3f}s throughput={throughput:.1f}/s", file=out)
+
+    print(f"{'tier':<20}{'count':>10}{'mean':>10}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}", file=out)
+    for (tier, histogram) in sorted(histograms.items()) + [("all", total)]:
+        print(
+            f"{tier:<20}{histogram.total:>10}"
+            + "".join(f"{v * 1000:>8.3f}ms" for v in [
+                histogram.mean(),
+                histogram.percentile(50),
+                histogram.percentile(90),
+                histogram.percentile(99),
+                histogram.max]),
+            file=out)
+
+    # Show the overall distribution, skipping empty buckets
+    print("latency histogram:", file=out)
+    peak = max(total.counts) if total.total > 0 else 0
+    lower = 0.0
+    for (i, count) in enumerate(total.counts):
+        upper = HISTOGRAM_BOUNDS[i] if i < len(HISTOGRAM_BOUNDS) else float("inf")
+        if count > 0:
+            bar = "#" * max(1, round(40 * count / peak))
+            print(f"  {lower * 1000:>9.3f}ms - {upper * 1000:>9.3f}ms {count:>10} {bar}", file=out)
+        lower = upper
+
+
+def run(args, out=sys.stdout):
+    api_keys = read_api_keys(args.api_keys)
+    events = read_events(args.events, args.repeat)
+
+    histograms = {}
+    completed = 0
+    start = time.perf_counter()
+
+    if args.processes <= 1:
+        if args.trace_memory:
+            tracemalloc.start()
+        instrument(api_keys, args.get_api_keys_latency_ms, args.dynamodb_latency_ms, args.authorizer_output)
+        for chunk in chunked(events, args.report_every):
+            for (tier, histogram) in replay(chunk).items():
+                histograms.setdefault(tier, Histogram()).merge(histogram)
+            completed += len(chunk)
+            print_memory_sample(completed, "main", sample_memory(), out)
+        flush_usage_counters()
+    else:
+        pool = multiprocessing.Pool(
+            args.processes,
+            initializer=init_worker,
+            initargs=(api_keys, args.get_api_keys_latency_ms, args.dynamodb_latency_ms, args.authorizer_output,
+                      args.trace_memory))
+        try:
+            for (chunk_histograms, worker, sample) in pool.imap_unordered(
+                    run_chunk, chunked(events, args.report_every)):
+                for (tier, histogram) in chunk_histograms.items():
+                    histograms.setdefault(tier, Histogram()).merge(histogram)
+                completed += sum(h.total for h in chunk_histograms.values())
+                print_memory_sample(completed, worker, sample, out)
+
+            # Let workers exit normally, so they flush their pending usage counts
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+
+    print_report(histograms, time.perf_counter() - start, out)
+
+    return histograms
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Replay recorded authorizer events through lambda_handler against local fakes")
+    parser.add_argument("events", nargs="+",
+                        help="JSON Lines files of authorizer events, one event per line")
+    parser.add_argument("--api-keys",
+                        help="JSON file of API keys as printed by `aws apigateway get-api-keys --include-values`")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Number of times to replay the event files")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Number of worker processes. 1 runs in-process.")
+    parser.add_argument("--get-api-keys-latency-ms", type=float, default=0,
+                        help="Latency to inject into each fake GetApiKeys page")
+    parser.add_argument("--dynamodb-latency-ms", type=float, default=0,
+                        help="Latency to inject into each fake DynamoDB call")
+    parser.add_argument("--report-every", type=int, default=1000,
+                        help="Number of events between memory samples")
+    parser.add_argument("--authorizer-output", default=os.devnull,
+                        help="File to append the authorizer's own log lines to. Discarded by default.")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Also report Python heap usage with tracemalloc, which slows the run")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    run(parse_args())
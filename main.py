@@ -1,6 +1,10 @@
 # This is a sample Python script.
 import base64
+import itertools
+import json
 import re
+import sys
+from collections import OrderedDict
 from os import getenv
 import boto3
 import time
@@ -21,6 +25,28 @@ CACHE_TABLE_NAME = getenv("CACHE_TABLE_NAME")
 
 MAX_API_KEY_CACHE_AGE_SECONDS = int(getenv("MAX_API_KEY_CACHE_AGE", "300"))
 
+API_KEY_PAGE_SIZE = int(getenv("API_KEY_PAGE_SIZE", "500"))
+
+API_KEY_LOOKUP_STRATEGY = getenv("API_KEY_LOOKUP_STRATEGY", "")
+
+API_KEY_LOOKUP_SWEEP_ON_MISS = getenv("API_KEY_LOOKUP_SWEEP_ON_MISS", "true").lower() == "true"
+
+API_KEY_MEMORY_CACHE_MAX_BYTES = int(getenv("API_KEY_MEMORY_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+API_KEY_MEMORY_CACHE_REPORT_INTERVAL_SECONDS = int(getenv("API_KEY_MEMORY_CACHE_REPORT_INTERVAL_SECONDS", "300"))
+
+USAGE_COUNTER_SINK = getenv("USAGE_COUNTER_SINK", "")
+
+USAGE_COUNTER_TABLE_NAME = getenv("USAGE_COUNTER_TABLE_NAME")
+
+USAGE_COUNTER_NAMESPACE = getenv("USAGE_COUNTER_NAMESPACE", "ApiKeyTagContextLambdaAuthorizer")
+
+USAGE_COUNTER_FLUSH_INTERVAL_SECONDS = int(getenv("USAGE_COUNTER_FLUSH_INTERVAL_SECONDS", "60"))
+
+USAGE_COUNTER_MAX_KEYS = int(getenv("USAGE_COUNTER_MAX_KEYS", "1000"))
+
+USAGE_COUNTER_MAX_WRITES_PER_FLUSH = int(getenv("USAGE_COUNTER_MAX_WRITES_PER_FLUSH", "25"))
+
 api_gateway_client = None
 
 
@@ -141,6 +167,7 @@ def get_api_key_cache_entry(value, now=None):
         return {
             "id": id,
             "value": value,
+            "timestamp": timestamp,
             "tags": tags
         }
 
@@ -181,11 +208,62 @@ def put_api_key_cache_entry(api_key, now = None):
         })
 
 
-def fetch_api_key(value):
+API_KEY_LOOKUP_STRATEGY_PATTERN = re.compile(r"(nameQuery|customerId):regex[(](.+)[)]")
+
+
+def parse_api_key_lookup_strategy(strategy):
+    """ Parse the given lookup strategy into a filter parameter and compiled pattern, or else None """
+
+    # If we're not filtering, then return None
+    if strategy == "":
+        return None
+
+    match = API_KEY_LOOKUP_STRATEGY_PATTERN.fullmatch(strategy)
+    if match is None:
+        print("WARNING: Ignoring unrecognized API key lookup strategy: " + strategy)
+        return None
+
+    try:
+        pattern = re.compile(match.group(2))
+    except re.error as e:
+        print("WARNING: Ignoring API key lookup strategy with invalid pattern: " + strategy + ": " + str(e))
+        return None
+
+    return (match.group(1), pattern)
+
+
+api_key_lookup_strategy = parse_api_key_lookup_strategy(API_KEY_LOOKUP_STRATEGY)
+
+
+def find_api_key_lookup_filter(value):
+    """ Derive GetApiKeys filter parameters from the given API key value if possible, or else None """
+
+    # If we're not filtering, then return None
+    if api_key_lookup_strategy is None:
+        return None
+    (parameter, pattern) = api_key_lookup_strategy
+
+    # The first group of the pattern, or else the whole match, is the filter value
+    segment = pattern.search(value)
+    if segment is None:
+        return None
+    filter_value = segment.group(1) if pattern.groups > 0 else segment.group(0)
+    if not filter_value:
+        return None
+
+    return {
+        parameter: filter_value
+    }
+
+
+def sweep_api_keys(value, lookup_filter):
+    """ Page through the API keys matching the given filter, returning the one with the given value if any """
+
     pages = get_api_gateway_client().get_paginator("get_api_keys").paginate(
         includeValues=True,
+        **lookup_filter,
         PaginationConfig={
-            'PageSize': 500
+            'PageSize': API_KEY_PAGE_SIZE
         })
     for page in pages:
         for item in page["items"]:
@@ -194,6 +272,346 @@ def fetch_api_key(value):
     return None
 
 
+def fetch_api_key(value):
+    # Try a narrow scan first if the API key value tells us where to look
+    lookup_filter = find_api_key_lookup_filter(value)
+    if lookup_filter is not None:
+        api_key = sweep_api_keys(value, lookup_filter)
+        if api_key is not None or not API_KEY_LOOKUP_SWEEP_ON_MISS:
+            return api_key
+
+    return sweep_api_keys(value, {})
+
+
+class ApiKeyTagSchema:
+    """ The tag names of one or more API keys, shared by every cached API key with the same tag names """
+
+    __slots__ = ("names", "indexes", "context_names", "context_indexes", "references", "size")
+
+    def __init__(self, names, context_prefix):
+        self.names = tuple(sys.intern(name) for name in names)
+        self.indexes = {name: i for (i, name) in enumerate(self.names)}
+
+        # Strip the context prefix once here instead of on every request
+        context_prefix_len = len(context_prefix)
+        context = [(sys.intern(name[context_prefix_len:]), i)
+                   for (i, name) in enumerate(self.names) if name.startswith(context_prefix)]
+        self.context_names = tuple(name for (name, _) in context)
+        self.context_indexes = tuple(i for (_, i) in context)
+
+        self.references = 0
+        self.size = (sys.getsizeof(self)
+                     + sys.getsizeof(self.names)
+                     + sys.getsizeof(self.indexes)
+                     + sys.getsizeof(self.context_names)
+                     + sys.getsizeof(self.context_indexes)
+                     + sum(sys.getsizeof(name) for name in self.names + self.context_names))
+
+
+class ApiKeyRecord:
+    """ A compact copy of the parts of an API key the authorizer needs """
+
+    __slots__ = ("id", "value", "schema", "tag_values", "timestamp", "size")
+
+    def __init__(self, id, value, schema, tag_values, timestamp):
+        self.id = id
+        self.value = value
+        self.schema = schema
+        self.tag_values = tag_values
+        self.timestamp = timestamp
+        self.size = (sys.getsizeof(self)
+                     + sys.getsizeof(id)
+                     + sys.getsizeof(value)
+                     + sys.getsizeof(tag_values)
+                     + sum(sys.getsizeof(v) for v in tag_values))
+
+    def tag(self, name, default=None):
+        """ Returns the value of the given tag if it exists, or else the default """
+
+        index = self.schema.indexes.get(name)
+        if index is None:
+            return default
+        return self.tag_values[index]
+
+    def context(self):
+        """ Returns a new dict of the context tags of this API key, with the context prefix removed """
+
+        tag_values = self.tag_values
+        return {name: tag_values[i] for (name, i) in zip(self.schema.context_names, self.schema.context_indexes)}
+
+
+# Cached API keys by value, least recently used first
+api_key_memory_cache = OrderedDict()
+
+# Tag schemas by tag names, shared between cached API keys
+api_key_tag_schemas = {}
+
+api_key_memory_cache_stats = {
+    "bytes": 0,
+    "hits": 0,
+    "misses": 0,
+    "evictions": 0,
+    "reported_at": None
+}
+
+# Rough size of one OrderedDict entry, which sys.getsizeof cannot see
+API_KEY_MEMORY_CACHE_ENTRY_OVERHEAD_BYTES = 100
+
+
+def create_api_key_record(api_key, timestamp):
+    """ Convert the given API key dict into a compact record, sharing its tag schema if possible """
+
+    # The tags key only exists if tags are present, so be defensive.
+    tags = api_key.get("tags", {})
+
+    names = tuple(tags.keys())
+    schema = api_key_tag_schemas.get(names)
+    if schema is None:
+        schema = ApiKeyTagSchema(names, CONTEXT_TAG_PREFIX)
+
+    return ApiKeyRecord(api_key["id"], api_key["value"], schema, tuple(tags.values()), timestamp)
+
+
+def remove_api_key_memory_cache_entry(value):
+    """ Remove the given API key value from the in-memory cache, releasing its tag schema if unused """
+
+    record = api_key_memory_cache.pop(value)
+    api_key_memory_cache_stats["bytes"] -= record.size + API_KEY_MEMORY_CACHE_ENTRY_OVERHEAD_BYTES
+
+    schema = record.schema
+    schema.references -= 1
+    if schema.references == 0:
+        del api_key_tag_schemas[schema.names]
+        api_key_memory_cache_stats["bytes"] -= schema.size
+
+
+def get_api_key_memory_cache_entry(value, now=None):
+    """ Check the in-memory cache for the given API key value """
+
+    # If we're not caching, then return None
+    if MAX_API_KEY_CACHE_AGE_SECONDS <= 0 or API_KEY_MEMORY_CACHE_MAX_BYTES <= 0:
+        return None
+
+    # If no timestamp was provided, use the current time
+    if now is None:
+        now = current_time_epoch()
+
+    record = api_key_memory_cache.get(value)
+    if record is not None and now - record.timestamp > MAX_API_KEY_CACHE_AGE_SECONDS:
+        remove_api_key_memory_cache_entry(value)
+        record = None
+
+    if record is None:
+        api_key_memory_cache_stats["misses"] += 1
+        return None
+
+    api_key_memory_cache_stats["hits"] += 1
+    api_key_memory_cache.move_to_end(value)
+
+    return record
+
+
+def put_api_key_memory_cache_entry(record):
+    """ Put the given record into the in-memory cache, evicting least recently used records to stay in budget """
+
+    # If we're not caching, then do nothing
+    if MAX_API_KEY_CACHE_AGE_SECONDS <= 0 or API_KEY_MEMORY_CACHE_MAX_BYTES <= 0:
+        return
+
+    if record.value in api_key_memory_cache:
+        remove_api_key_memory_cache_entry(record.value)
+
+    schema = record.schema
+    if schema.references == 0:
+        api_key_tag_schemas[schema.names] = schema
+        api_key_memory_cache_stats["bytes"] += schema.size
+    schema.references += 1
+
+    api_key_memory_cache[record.value] = record
+    api_key_memory_cache_stats["bytes"] += record.size + API_KEY_MEMORY_CACHE_ENTRY_OVERHEAD_BYTES
+
+    # Always keep the newest record, even if it alone is over budget
+    while api_key_memory_cache_stats["bytes"] > API_KEY_MEMORY_CACHE_MAX_BYTES and len(api_key_memory_cache) > 1:
+        remove_api_key_memory_cache_entry(next(iter(api_key_memory_cache)))
+        api_key_memory_cache_stats["evictions"] += 1
+
+
+def clear_api_key_memory_cache():
+    """ Remove all records from the in-memory cache and reset its statistics """
+
+    api_key_memory_cache.clear()
+    api_key_tag_schemas.clear()
+    api_key_memory_cache_stats.update(bytes=0, hits=0, misses=0, evictions=0, reported_at=None)
+
+
+def report_api_key_memory_cache(now=None):
+    """ Print the in-memory cache's memory usage, at most once per report interval """
+
+    # If we're not reporting, then do nothing
+    if API_KEY_MEMORY_CACHE_REPORT_INTERVAL_SECONDS <= 0:
+        return
+
+    # If no timestamp was provided, use the current time
+    if now is None:
+        now = current_time_epoch()
+
+    reported_at = api_key_memory_cache_stats["reported_at"]
+    if reported_at is not None and now - reported_at < API_KEY_MEMORY_CACHE_REPORT_INTERVAL_SECONDS:
+        return
+    api_key_memory_cache_stats["reported_at"] = now
+
+    print("INFO: API key memory cache"
+          + " entries=" + str(len(api_key_memory_cache))
+          + " schemas=" + str(len(api_key_tag_schemas))
+          + " bytes=" + str(api_key_memory_cache_stats["bytes"])
+          + " maxBytes=" + str(API_KEY_MEMORY_CACHE_MAX_BYTES)
+          + " hits=" + str(api_key_memory_cache_stats["hits"])
+          + " misses=" + str(api_key_memory_cache_stats["misses"])
+          + " evictions=" + str(api_key_memory_cache_stats["evictions"]))
+
+
+# Authorization counts per (principal ID, API key ID) that have not been flushed yet
+usage_counters = {}
+
+usage_counters_flushed_at = None
+
+# When the most recent flush failed, or else None
+usage_counters_failed_at = None
+
+
+def write_usage_counters_to_dynamodb(counters):
+    """ Add the given counts to the usage counter table, removing each count from the dict once written """
+
+    for ((principal_id, api_key_id), count) in list(counters.items()):
+        get_dynanodb_client().update_item(
+            TableName=USAGE_COUNTER_TABLE_NAME,
+            Key={
+                "id": {
+                    "S": api_key_id
+                }
+            },
+            UpdateExpression="SET principalId = :principalId ADD authorizations :count",
+            ExpressionAttributeValues={
+                ":principalId": {
+                    "S": principal_id
+                },
+                ":count": {
+                    "N": str(count)
+                }
+            })
+        del counters[(principal_id, api_key_id)]
+
+
+def write_usage_counters_to_emf(counters, now):
+    """ Print the given counts as CloudWatch Embedded Metric Format lines, one per API key per flush """
+
+    lines = []
+    for ((principal_id, api_key_id), count) in counters.items():
+        lines.append(json.dumps({
+            "_aws": {
+                "Timestamp": now * 1000,
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": USAGE_COUNTER_NAMESPACE,
+                        "Dimensions": [["PrincipalId", "ApiKeyId"]],
+                        "Metrics": [
+                            {
+                                "Name": "Authorizations",
+                                "Unit": "Count"
+                            }
+                        ]
+                    }
+                ]
+            },
+            "PrincipalId": principal_id,
+            "ApiKeyId": api_key_id,
+            "Authorizations": count
+        }))
+    if lines:
+        print("\n".join(lines))
+    counters.clear()
+
+
+def flush_usage_counters(now=None):
+    """ Write the oldest pending usage counts to the configured sink, at most one batch per call """
+
+    global usage_counters, usage_counters_flushed_at, usage_counters_failed_at
+
+    # If no timestamp was provided, use the current time
+    if now is None:
+        now = current_time_epoch()
+
+    # Take out one batch of the oldest counts, so a single request never pays for writing every pending count
+    counters = {}
+    for key in list(itertools.islice(usage_counters, max(USAGE_COUNTER_MAX_WRITES_PER_FLUSH, 1))):
+        counters[key] = usage_counters.pop(key)
+
+    try:
+        if len(counters) == 0:
+            pass
+        elif USAGE_COUNTER_SINK == "dynamodb":
+            write_usage_counters_to_dynamodb(counters)
+        elif USAGE_COUNTER_SINK == "emf":
+            write_usage_counters_to_emf(counters, now)
+        else:
+            print("WARNING: Ignoring unrecognized usage counter sink: " + USAGE_COUNTER_SINK)
+            counters.clear()
+    except Exception as e:
+        # Keep the unwritten counts for the next flush rather than losing billable usage. Counts that were
+        # already written have been removed, so they are not counted twice.
+        print("WARNING: Failed to flush usage counters: " + str(e))
+
+        # Put the unwritten counts back in front of newer ones, so the oldest counts are still written first
+        for (k, v) in usage_counters.items():
+            counters[k] = counters.get(k, 0) + v
+        usage_counters = counters
+
+        # Back off for a full interval instead of retrying on every request
+        usage_counters_flushed_at = now
+        usage_counters_failed_at = now
+        return
+
+    usage_counters_failed_at = None
+
+    # Counts left over after this batch are written by the next invocations, one batch each
+    if len(usage_counters) == 0:
+        usage_counters_flushed_at = now
+
+
+def record_usage(principal_id, api_key_id, now=None):
+    """ Count one authorization for the given principal and API key, flushing in batches """
+
+    global usage_counters_flushed_at
+
+    # If we're not counting, then do nothing
+    if USAGE_COUNTER_SINK == "":
+        return
+
+    # If no timestamp was provided, use the current time
+    if now is None:
+        now = current_time_epoch()
+
+    # The first invocation in a container starts the flush interval
+    if usage_counters_flushed_at is None:
+        usage_counters_flushed_at = now
+
+    # Memory is bounded by the number of distinct keys, so flush early if we would exceed it, unless we are
+    # backing off after a failed flush
+    key = (principal_id, api_key_id)
+    backing_off = (usage_counters_failed_at is not None
+                   and now - usage_counters_failed_at < USAGE_COUNTER_FLUSH_INTERVAL_SECONDS)
+    if key not in usage_counters and len(usage_counters) >= USAGE_COUNTER_MAX_KEYS and not backing_off:
+        flush_usage_counters(now)
+    if key not in usage_counters and len(usage_counters) >= USAGE_COUNTER_MAX_KEYS:
+        print("WARNING: Dropping usage count for API key " + api_key_id + " because usage counters are full")
+        return
+
+    usage_counters[key] = usage_counters.get(key, 0) + 1
+
+    if now - usage_counters_flushed_at >= USAGE_COUNTER_FLUSH_INTERVAL_SECONDS:
+        flush_usage_counters(now)
+
+
 # https://github.com/amazon-archives/serverless-app-examples/tree/master/python/api-gateway-authorizer-python
 # https://docs.aws.amazon.com/apigateway/latest/developerguide/api-gateway-lambda-authorizer-input.html#w38aac15b9c11c26c29b5
 def lambda_handler(request, context):
@@ -204,20 +622,24 @@ def lambda_handler(request, context):
         raise Exception("Unauthorized")
 
     # TODO Implement other schemes for looking up API key from API Gateway API
-    api_key = None
-    api_key_cached = False
-    if api_key is None:
-        api_key = get_api_key_cache_entry(api_key_value)
-        if api_key is not None:
-            api_key_cached = True
+    now = current_time_epoch()
+    api_key = get_api_key_memory_cache_entry(api_key_value, now)
     if api_key is None:
-        api_key = fetch_api_key(api_key_value)
-    if api_key is None:
-        raise Exception("Unauthorized")
-
-    # If we didn't find the API key in the cache, then put it there
-    if not api_key_cached:
-        put_api_key_cache_entry(api_key)
+        api_key_item = get_api_key_cache_entry(api_key_value)
+        api_key_cached = api_key_item is not None
+        if api_key_item is None:
+            api_key_item = fetch_api_key(api_key_value)
+        if api_key_item is None:
+            raise Exception("Unauthorized")
+
+        # If we didn't find the API key in the cache, then put it there
+        if not api_key_cached:
+            put_api_key_cache_entry(api_key_item)
+
+        # Keep a compact copy in memory, aged from when it was first loaded
+        api_key = create_api_key_record(api_key_item, api_key_item.get("timestamp", now))
+        put_api_key_memory_cache_entry(api_key)
+    report_api_key_memory_cache(now)
 
     # Let's extract some important facts about this API request
     request_context = request["requestContext"]
@@ -225,26 +647,21 @@ def lambda_handler(request, context):
     api_id = request_context["apiId"]
     api_stage = request_context["stage"]
 
-    # Grab our API key tags. The tags key only exists if tags are present, so be defensive.
-    tags = api_key.get("tags", {})
-
     # Grab our principal ID from our tags
     principal_id = DEFAULT_PRINCIPAL_ID
     if PRINCIPAL_ID_TAG_NAME is not None:
-        principal_id = tags.get(PRINCIPAL_ID_TAG_NAME, DEFAULT_PRINCIPAL_ID)
+        principal_id = api_key.tag(PRINCIPAL_ID_TAG_NAME, DEFAULT_PRINCIPAL_ID)
     if principal_id is None:
         raise Exception("Unauthorized")
 
+    # Count this authorization for usage reporting
+    record_usage(principal_id, api_key.id, now)
+
     # What headers do we need to copy from the request to the context?
     copy_request_headers = COPY_REQUEST_HEADERS.split(",") if COPY_REQUEST_HEADERS != "" else []
 
     # Now compute our context from our tags
-    context = {}
-    context_prefix = CONTEXT_TAG_PREFIX
-    context_prefix_len = len(context_prefix)
-    for (k, v) in tags.items():
-        if k.startswith(context_prefix):
-            context[k[context_prefix_len:]] = v
+    context = api_key.context()
     for header_name in copy_request_headers:
         header_value = find_first_header_value(request, header_name)
         if header_value is not None:
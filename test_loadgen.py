@@ -0,0 +1,232 @@
+import io
+import json
+from unittest.mock import patch
+
+import pytest
+
+import main
+
+from loadgen import FakeApiGatewayClient
+from loadgen import Histogram
+from loadgen import HISTOGRAM_BOUNDS
+from loadgen import instrument
+from loadgen import parse_args
+from loadgen import replay
+from loadgen import run
+
+API_KEYS = [
+    {
+        "id": "alpha",
+        "name": "acme-alpha",
+        "value": "hello",
+        "tags": {
+            "principal": "principal_id",
+            "context:bravo": "charlie"
+        }
+    },
+    {
+        "id": "delta",
+        "name": "other-delta",
+        "value": "goodbye",
+        "tags": {}
+    }
+]
+
+
+def event(api_key_value):
+    return {
+        "requestContext": {
+            "accountId": "aws_account_id",
+            "apiId": "api_id",
+            "stage": "api_stage"
+        },
+        "headers": {
+            "authorization": "bearer " + api_key_value
+        }
+    }
+
+
+@pytest.fixture(autouse=True)
+def api_key_memory_cache():
+    main.clear_api_key_memory_cache()
+    yield
+    main.clear_api_key_memory_cache()
+
+
+# Histogram
+def test_histogram_percentile():
+    histogram = Histogram()
+    for _ in range(90):
+        histogram.record(0.001)
+    for _ in range(10):
+        histogram.record(0.1)
+
+    assert histogram.total == 100
+    assert 0.001 <= histogram.percentile(50) < 0.00125
+    assert histogram.percentile(99) == 0.1
+    assert histogram.percentile(99) <= histogram.max
+    assert histogram.max == 0.1
+
+
+def test_histogram_merge():
+    a = Histogram()
+    a.record(0.001)
+    b = Histogram()
+    b.record(0.002)
+    b.record(100)
+
+    a.merge(b)
+
+    assert a.total == 3
+    assert a.max == 100
+    assert a.counts[len(HISTOGRAM_BOUNDS)] == 1
+
+
+# FakeApiGatewayClient
+def test_fake_api_gateway_client_pages_and_filters():
+    api_keys = [{"id": str(i), "name": "n" + str(i), "value": str(i)} for i in range(12)]
+    paginator = FakeApiGatewayClient(api_keys).get_paginator("get_api_keys")
+
+    pages = list(paginator.paginate(PaginationConfig={"PageSize": 5}))
+    assert [len(page["items"]) for page in pages] == [5, 5, 2]
+
+    pages = list(paginator.paginate(nameQuery="n1", PaginationConfig={"PageSize": 5}))
+    assert [item["id"] for page in pages for item in page["items"]] == ["1", "10", "11"]
+
+
+# replay
+@patch("main.print", print, create=True)
+@patch("main.get_api_key_memory_cache_entry", main.get_api_key_memory_cache_entry)
+@patch("main.get_api_key_cache_entry", main.get_api_key_cache_entry)
+@patch("main.fetch_api_key", main.fetch_api_key)
+@patch("main.api_gateway_client", None)
+@patch("main.dynamodb_client", None)
+@patch("main.CACHE_TABLE_NAME", None)
+@patch("main.USAGE_COUNTER_TABLE_NAME", None)
+@patch("main.DEFAULT_PRINCIPAL_ID", None)
+@patch("main.PRINCIPAL_ID_TAG_NAME", "principal")
+@patch("main.MAX_API_KEY_CACHE_AGE_SECONDS", 300)
+def test_replay_breaks_down_by_cache_tier():
+    instrument(API_KEYS, 0, 0)
+
+    histograms = replay([
+        event("hello"),
+        event("hello"),
+        event("goodbye"),
+        event("missing"),
+        {"headers": {}},
+        {"headers": {"authorization": "bearer hello"}},
+        {}
+    ])
+    with patch("main.AUTHORIZATION_PLAN", "authorization:bearer(base64)"):
+        for (tier, histogram) in replay([event("abc")]).items():
+            histograms.setdefault(tier, Histogram()).merge(histogram)
+
+    assert {tier: histogram.total for (tier, histogram) in histograms.items()} == {
+        "get_api_keys": 1,
+        "memory": 1,
+        "get_api_keys denied": 2,
+        "none denied": 1,
+        "error": 3
+    }
+
+
+# instrument
+@patch("main.print", print, create=True)
+@patch("main.get_api_key_memory_cache_entry", main.get_api_key_memory_cache_entry)
+@patch("main.get_api_key_cache_entry", main.get_api_key_cache_entry)
+@patch("main.fetch_api_key", main.fetch_api_key)
+@patch("main.api_gateway_client", None)
+@patch("main.dynamodb_client", None)
+@patch("main.CACHE_TABLE_NAME", None)
+@patch("main.USAGE_COUNTER_TABLE_NAME", None)
+@patch("main.usage_counters", {})
+@patch("main.usage_counters_flushed_at", None)
+@patch("main.usage_counters_failed_at", None)
+@patch("main.USAGE_COUNTER_SINK", "dynamodb")
+@patch("main.USAGE_COUNTER_FLUSH_INTERVAL_SECONDS", 0)
+@patch("main.DEFAULT_PRINCIPAL_ID", None)
+@patch("main.PRINCIPAL_ID_TAG_NAME", "principal")
+@patch("main.MAX_API_KEY_CACHE_AGE_SECONDS", 300)
+def test_instrument_separates_fake_tables():
+    instrument(API_KEYS, 0, 0)
+
+    replay([event("hello")])
+
+    tables = main.dynamodb_client.tables
+    assert set(tables.keys()) == {"cache", "usage"}
+    assert set(tables["cache"].keys()) == {"hello"}
+    assert tables["usage"] == {"alpha": {"count": 1}}
+
+
+# run
+@patch("main.print", print, create=True)
+@patch("main.get_api_key_memory_cache_entry", main.get_api_key_memory_cache_entry)
+@patch("main.get_api_key_cache_entry", main.get_api_key_cache_entry)
+@patch("main.fetch_api_key", main.fetch_api_key)
+@patch("main.api_gateway_client", None)
+@patch("main.dynamodb_client", None)
+@patch("main.CACHE_TABLE_NAME", None)
+@patch("main.USAGE_COUNTER_TABLE_NAME", None)
+@patch("main.DEFAULT_PRINCIPAL_ID", None)
+@patch("main.PRINCIPAL_ID_TAG_NAME", "principal")
+@patch("main.MAX_API_KEY_CACHE_AGE_SECONDS", 300)
+def test_run_in_process(tmp_path):
+    events_path = tmp_path / "events.jsonl"
+    events_path.write_text("\n".join(json.dumps(event("hello")) for _ in range(5)) + "\n")
+    api_keys_path = tmp_path / "keys.json"
+    api_keys_path.write_text(json.dumps({"items": API_KEYS}))
+
+    out = io.StringIO()
+    histograms = run(parse_args([
+        str(events_path),
+        "--api-keys", str(api_keys_path),
+        "--repeat", "2",
+        "--report-every", "4"
+    ]), out)
+
+    assert sum(histogram.total for histogram in histograms.values()) == 10
+    assert histograms["memory"].total == 9
+
+    report = out.getvalue()
+    assert report.count("memory events=") == 3
+    assert "events=10 " in report
+
+
+@patch("main.print", print, create=True)
+@patch("main.get_api_key_memory_cache_entry", main.get_api_key_memory_cache_entry)
+@patch("main.get_api_key_cache_entry", main.get_api_key_cache_entry)
+@patch("main.fetch_api_key", main.fetch_api_key)
+@patch("main.api_gateway_client", None)
+@patch("main.dynamodb_client", None)
+@patch("main.CACHE_TABLE_NAME", None)
+@patch("main.USAGE_COUNTER_TABLE_NAME", None)
+@patch("main.usage_counters", {})
+@patch("main.usage_counters_flushed_at", None)
+@patch("main.usage_counters_failed_at", None)
+@patch("main.USAGE_COUNTER_SINK", "emf")
+@patch("main.USAGE_COUNTER_FLUSH_INTERVAL_SECONDS", 3600)
+@patch("main.DEFAULT_PRINCIPAL_ID", None)
+@patch("main.PRINCIPAL_ID_TAG_NAME", "principal")
+@patch("main.MAX_API_KEY_CACHE_AGE_SECONDS", 300)
+def test_run_redirects_authorizer_output_and_flushes_usage(tmp_path, capsys):
+    events_path = tmp_path / "events.jsonl"
+    events_path.write_text("\n".join(json.dumps(event("hello")) for _ in range(5)) + "\n")
+    api_keys_path = tmp_path / "keys.json"
+    api_keys_path.write_text(json.dumps({"items": API_KEYS}))
+    authorizer_output_path = tmp_path / "authorizer.log"
+
+    out = io.StringIO()
+    run(parse_args([
+        str(events_path),
+        "--api-keys", str(api_keys_path),
+        "--authorizer-output", str(authorizer_output_path)
+    ]), out)
+    main.print.keywords["file"].close()
+
+    assert capsys.readouterr().out == ""
+    assert "_aws" not in out.getvalue()
+
+    metrics = [json.loads(line) for line in authorizer_output_path.read_text().splitlines() if "_aws" in line]
+    assert [(metric["ApiKeyId"], metric["Authorizations"]) for metric in metrics] == [("alpha", 5)]
+    assert main.usage_counters == {}
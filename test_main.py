@@ -1,9 +1,28 @@
+import json
 from unittest.mock import patch, Mock
 
+import pytest
+
+import main
+
 from main import find_first_header_value
 from main import find_api_key_in_request
 from main import fetch_api_key
+from main import find_api_key_lookup_filter
+from main import parse_api_key_lookup_strategy
 from main import lambda_handler
+from main import record_usage
+from main import flush_usage_counters
+from main import create_api_key_record
+from main import get_api_key_memory_cache_entry
+from main import put_api_key_memory_cache_entry
+
+
+@pytest.fixture(autouse=True)
+def api_key_memory_cache():
+    main.clear_api_key_memory_cache()
+    yield
+    main.clear_api_key_memory_cache()
 
 
 # lambda_handler
@@ -333,6 +352,108 @@ def test_lambda_handler_api_key_given_exists_default_principal_id(
     }
 
 
+@patch("main.current_time_epoch")
+@patch("main.get_api_gateway_client")
+@patch("main.get_api_key_cache_entry")
+@patch("main.put_api_key_cache_entry")
+@patch("main.DEFAULT_PRINCIPAL_ID", "foobar")
+@patch("main.PRINCIPAL_ID_TAG_NAME", "principal")
+@patch("main.AWS_REGION", "us-east-1")
+@patch("main.MAX_API_KEY_CACHE_AGE_SECONDS", 300)
+def test_lambda_handler_api_key_given_exists_memory_cached(
+        mock_put_api_key_cache_entry,
+        mock_get_api_key_cache_entry,
+        mock_get_api_gateway_client,
+        mock_current_time_epoch):
+    mock_current_time_epoch.return_value = 1234567890
+    mock_get_api_key_cache_entry.return_value = {
+        "id": "alpha",
+        "value": "hello",
+        "timestamp": 1234567880,
+        "tags": {
+            "principal": "principal_id",
+            "context:bravo": "charlie"
+        }
+    }
+
+    request = {
+        "requestContext": {
+            "accountId": "aws_account_id",
+            "apiId": "api_id",
+            "stage": "api_stage"
+        },
+        "headers": {
+            "authorization": "bearer hello"
+        }
+    }
+
+    first_response = lambda_handler(request, None)
+    first_response["context"]["mutated"] = "yes"
+    second_response = lambda_handler(request, None)
+
+    assert second_response["principalId"] == "principal_id"
+    assert second_response["context"] == {"bravo": "charlie"}
+
+    mock_get_api_key_cache_entry.assert_called_once()
+    mock_get_api_gateway_client.assert_not_called()
+
+
+# api key memory cache
+@patch("main.CONTEXT_TAG_PREFIX", "context:")
+def test_create_api_key_record_shares_tag_schema():
+    now = 1234567890
+    alpha = create_api_key_record({
+        "id": "alpha",
+        "value": "hello",
+        "name": "ignored",
+        "enabled": True,
+        "tags": {"principal": "a", "context:plan": "pro"}
+    }, now)
+    put_api_key_memory_cache_entry(alpha)
+    bravo = create_api_key_record({
+        "id": "bravo",
+        "value": "goodbye",
+        "tags": {"principal": "b", "context:plan": "free"}
+    }, now)
+
+    assert not hasattr(alpha, "__dict__")
+    assert alpha.schema is bravo.schema
+    assert alpha.tag("principal") == "a"
+    assert alpha.tag("missing", "default") == "default"
+    assert bravo.context() == {"plan": "free"}
+
+
+@patch("main.MAX_API_KEY_CACHE_AGE_SECONDS", 300)
+def test_api_key_memory_cache_expires():
+    now = 1234567890
+    put_api_key_memory_cache_entry(create_api_key_record({"id": "alpha", "value": "hello"}, now))
+
+    assert get_api_key_memory_cache_entry("hello", now + 300).id == "alpha"
+    assert get_api_key_memory_cache_entry("hello", now + 301) is None
+    assert len(main.api_key_memory_cache) == 0
+    assert main.api_key_memory_cache_stats["bytes"] == 0
+
+
+@patch("main.MAX_API_KEY_CACHE_AGE_SECONDS", 300)
+def test_api_key_memory_cache_evicts_least_recently_used():
+    now = 1234567890
+    records = [create_api_key_record({"id": str(i), "value": "key" + str(i), "tags": {"principal": str(i)}}, now)
+               for i in range(3)]
+
+    with patch("main.API_KEY_MEMORY_CACHE_MAX_BYTES", 1024 * 1024):
+        for record in records[0:2]:
+            put_api_key_memory_cache_entry(record)
+        budget = main.api_key_memory_cache_stats["bytes"]
+
+    with patch("main.API_KEY_MEMORY_CACHE_MAX_BYTES", budget):
+        get_api_key_memory_cache_entry("key0", now)
+        put_api_key_memory_cache_entry(records[2])
+
+        assert list(main.api_key_memory_cache.keys()) == ["key0", "key2"]
+        assert main.api_key_memory_cache_stats["bytes"] <= budget
+        assert main.api_key_memory_cache_stats["evictions"] == 1
+
+
 # fetch_api_key
 @patch("main.get_api_gateway_client")
 def test_fetch_api_key_missing(mock_get_api_gateway_client):
@@ -382,6 +503,332 @@ def test_fetch_api_key_present(mock_get_api_gateway_client):
     assert api_key["id"] == "b"
 
 
+# record_usage
+@patch("main.get_dynanodb_client")
+@patch("main.usage_counters", {})
+@patch("main.usage_counters_flushed_at", None)
+@patch("main.usage_counters_failed_at", None)
+@patch("main.USAGE_COUNTER_SINK", "dynamodb")
+@patch("main.USAGE_COUNTER_TABLE_NAME", "usage")
+@patch("main.USAGE_COUNTER_FLUSH_INTERVAL_SECONDS", 60)
+@patch("main.USAGE_COUNTER_MAX_KEYS", 1000)
+def test_record_usage_flushes_after_interval(mock_get_dynamodb_client):
+    dynamodb_client = Mock()
+    mock_get_dynamodb_client.return_value = dynamodb_client
+
+    now = 1234567890
+    for i in range(100):
+        record_usage("principal_id", "alpha", now)
+    record_usage("other_principal_id", "bravo", now + 30)
+
+    dynamodb_client.update_item.assert_not_called()
+
+    record_usage("principal_id", "alpha", now + 60)
+
+    assert dynamodb_client.update_item.call_count == 2
+    counts = {
+        c.kwargs["Key"]["id"]["S"]: c.kwargs["ExpressionAttributeValues"][":count"]["N"]
+        for c in dynamodb_client.update_item.call_args_list
+    }
+    assert counts == {"alpha": "101", "bravo": "1"}
+
+
+@patch("main.get_dynanodb_client")
+@patch("main.usage_counters", {})
+@patch("main.usage_counters_flushed_at", None)
+@patch("main.usage_counters_failed_at", None)
+@patch("main.USAGE_COUNTER_SINK", "dynamodb")
+@patch("main.USAGE_COUNTER_TABLE_NAME", "usage")
+@patch("main.USAGE_COUNTER_FLUSH_INTERVAL_SECONDS", 60)
+@patch("main.USAGE_COUNTER_MAX_KEYS", 2)
+def test_record_usage_flushes_when_full(mock_get_dynamodb_client):
+    dynamodb_client = Mock()
+    mock_get_dynamodb_client.return_value = dynamodb_client
+
+    now = 1234567890
+    record_usage("principal_id", "alpha", now)
+    record_usage("principal_id", "bravo", now)
+    record_usage("principal_id", "alpha", now)
+
+    dynamodb_client.update_item.assert_not_called()
+
+    record_usage("principal_id", "charlie", now)
+
+    assert dynamodb_client.update_item.call_count == 2
+
+    assert main.usage_counters == {("principal_id", "charlie"): 1}
+
+
+@patch("main.get_dynanodb_client")
+@patch("main.usage_counters", {})
+@patch("main.usage_counters_flushed_at", None)
+@patch("main.usage_counters_failed_at", None)
+@patch("main.USAGE_COUNTER_SINK", "dynamodb")
+@patch("main.USAGE_COUNTER_TABLE_NAME", "usage")
+@patch("main.USAGE_COUNTER_FLUSH_INTERVAL_SECONDS", 60)
+@patch("main.USAGE_COUNTER_MAX_KEYS", 1000)
+@patch("main.USAGE_COUNTER_MAX_WRITES_PER_FLUSH", 2)
+def test_record_usage_bounds_writes_per_flush(mock_get_dynamodb_client):
+    dynamodb_client = Mock()
+    mock_get_dynamodb_client.return_value = dynamodb_client
+
+    now = 1234567890
+    for api_key_id in ["a", "b", "c", "d", "e"]:
+        record_usage("principal_id", api_key_id, now)
+
+    writes = []
+    for i in range(4):
+        record_usage("principal_id", "a", now + 60 + i)
+        writes.append(dynamodb_client.update_item.call_count - sum(writes))
+
+    assert writes == [2, 2, 2, 0]
+    assert main.usage_counters == {("principal_id", "a"): 1}
+    assert main.usage_counters_flushed_at == now + 62
+
+    written = [c.kwargs["Key"]["id"]["S"] for c in dynamodb_client.update_item.call_args_list]
+    assert sorted(written) == ["a", "a", "b", "c", "d", "e"]
+
+
+@patch("main.get_dynanodb_client")
+@patch("main.usage_counters", {})
+@patch("main.usage_counters_flushed_at", None)
+@patch("main.usage_counters_failed_at", None)
+@patch("main.USAGE_COUNTER_SINK", "dynamodb")
+@patch("main.USAGE_COUNTER_TABLE_NAME", "usage")
+@patch("main.USAGE_COUNTER_FLUSH_INTERVAL_SECONDS", 60)
+@patch("main.USAGE_COUNTER_MAX_KEYS", 2)
+def test_record_usage_full_backs_off_after_failed_flush(mock_get_dynamodb_client):
+    dynamodb_client = Mock()
+    dynamodb_client.update_item.side_effect = Exception("Throttled")
+    mock_get_dynamodb_client.return_value = dynamodb_client
+
+    now = 1234567890
+    for i in range(10):
+        record_usage("principal_id", str(i), now)
+
+    assert dynamodb_client.update_item.call_count == 1
+
+    for i in range(10, 20):
+        record_usage("principal_id", str(i), now + 59)
+
+    assert dynamodb_client.update_item.call_count == 1
+
+    for i in range(20, 30):
+        record_usage("principal_id", str(i), now + 60)
+
+    assert dynamodb_client.update_item.call_count == 2
+    assert len(main.usage_counters) == 2
+
+
+@patch("main.get_dynanodb_client")
+@patch("main.usage_counters", {("principal_id", "alpha"): 3})
+@patch("main.usage_counters_flushed_at", 1234567890)
+@patch("main.usage_counters_failed_at", None)
+@patch("main.USAGE_COUNTER_SINK", "dynamodb")
+@patch("main.USAGE_COUNTER_TABLE_NAME", "usage")
+def test_flush_usage_counters_keeps_counts_on_failure(mock_get_dynamodb_client):
+    dynamodb_client = Mock()
+    dynamodb_client.update_item.side_effect = Exception("Throttled")
+    mock_get_dynamodb_client.return_value = dynamodb_client
+
+    flush_usage_counters(1234567890)
+
+    assert main.usage_counters == {("principal_id", "alpha"): 3}
+
+
+@patch("main.get_dynanodb_client")
+@patch("main.usage_counters", {("principal_id", "alpha"): 5, ("principal_id", "bravo"): 7})
+@patch("main.usage_counters_flushed_at", 1234567890)
+@patch("main.usage_counters_failed_at", None)
+@patch("main.USAGE_COUNTER_SINK", "dynamodb")
+@patch("main.USAGE_COUNTER_TABLE_NAME", "usage")
+def test_flush_usage_counters_writes_each_count_once_on_partial_failure(mock_get_dynamodb_client):
+    written = []
+    failures = [Exception("Throttled")]
+
+    def update_item(Key, ExpressionAttributeValues, **kwargs):
+        if len(written) == 1 and failures:
+            raise failures.pop()
+        written.append((Key["id"]["S"], ExpressionAttributeValues[":count"]["N"]))
+
+    dynamodb_client = Mock()
+    dynamodb_client.update_item.side_effect = update_item
+    mock_get_dynamodb_client.return_value = dynamodb_client
+
+    flush_usage_counters(1234567890)
+
+    assert main.usage_counters == {("principal_id", "bravo"): 7}
+
+    flush_usage_counters(1234567950)
+
+    assert main.usage_counters == {}
+    assert written == [("alpha", "5"), ("bravo", "7")]
+
+
+@patch("main.get_dynanodb_client")
+@patch("main.usage_counters", {("principal_id", "alpha"): 1, ("principal_id", "bravo"): 2, ("principal_id", "charlie"): 3})
+@patch("main.usage_counters_flushed_at", 1234567890)
+@patch("main.usage_counters_failed_at", None)
+@patch("main.USAGE_COUNTER_SINK", "dynamodb")
+@patch("main.USAGE_COUNTER_TABLE_NAME", "usage")
+@patch("main.USAGE_COUNTER_MAX_WRITES_PER_FLUSH", 2)
+def test_flush_usage_counters_keeps_oldest_first_on_failure(mock_get_dynamodb_client):
+    dynamodb_client = Mock()
+    dynamodb_client.update_item.side_effect = Exception("Throttled")
+    mock_get_dynamodb_client.return_value = dynamodb_client
+
+    flush_usage_counters(1234567890)
+
+    assert list(main.usage_counters.items()) == [
+        (("principal_id", "alpha"), 1),
+        (("principal_id", "bravo"), 2),
+        (("principal_id", "charlie"), 3)
+    ]
+
+
+@patch("main.usage_counters", {("principal_id", "alpha"): 3})
+@patch("main.usage_counters_flushed_at", 1234567890)
+@patch("main.usage_counters_failed_at", None)
+@patch("main.USAGE_COUNTER_SINK", "emf")
+@patch("main.USAGE_COUNTER_NAMESPACE", "Namespace")
+def test_flush_usage_counters_emf(capsys):
+    flush_usage_counters(1234567890)
+
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 1
+
+    metric = json.loads(lines[0])
+    assert metric["_aws"]["CloudWatchMetrics"][0]["Namespace"] == "Namespace"
+    assert metric["PrincipalId"] == "principal_id"
+    assert metric["ApiKeyId"] == "alpha"
+    assert metric["Authorizations"] == 3
+
+
+@patch("main.get_api_gateway_client")
+@patch("main.API_KEY_PAGE_SIZE", 100)
+@patch("main.api_key_lookup_strategy", parse_api_key_lookup_strategy("nameQuery:regex(^([a-z]+)_)"))
+def test_fetch_api_key_filtered(mock_get_api_gateway_client):
+    api_gateway_client_paginator = Mock()
+    api_gateway_client_paginator.paginate.return_value = [{
+        "items": [
+            {
+                "id": "b",
+                "value": "acme_hello"
+            }
+        ]
+    }]
+
+    api_gateway_client = Mock()
+    api_gateway_client.get_paginator.return_value = api_gateway_client_paginator
+
+    mock_get_api_gateway_client.return_value = api_gateway_client
+
+    api_key = fetch_api_key("acme_hello")
+
+    assert api_key["id"] == "b"
+    api_gateway_client_paginator.paginate.assert_called_once_with(
+        includeValues=True,
+        nameQuery="acme",
+        PaginationConfig={
+            'PageSize': 100
+        })
+
+
+@patch("main.get_api_gateway_client")
+@patch("main.api_key_lookup_strategy", parse_api_key_lookup_strategy("customerId:regex(^([a-z]+)_)"))
+@patch("main.API_KEY_LOOKUP_SWEEP_ON_MISS", True)
+def test_fetch_api_key_filtered_miss_sweeps(mock_get_api_gateway_client):
+    api_gateway_client_paginator = Mock()
+    api_gateway_client_paginator.paginate.side_effect = [
+        [{"items": []}],
+        [{"items": [{"id": "b", "value": "acme_hello"}]}]
+    ]
+
+    api_gateway_client = Mock()
+    api_gateway_client.get_paginator.return_value = api_gateway_client_paginator
+
+    mock_get_api_gateway_client.return_value = api_gateway_client
+
+    api_key = fetch_api_key("acme_hello")
+
+    assert api_key["id"] == "b"
+    assert api_gateway_client_paginator.paginate.call_count == 2
+    assert api_gateway_client_paginator.paginate.call_args_list[0].kwargs["customerId"] == "acme"
+    assert "customerId" not in api_gateway_client_paginator.paginate.call_args_list[1].kwargs
+
+
+@patch("main.get_api_gateway_client")
+@patch("main.api_key_lookup_strategy", parse_api_key_lookup_strategy("customerId:regex(^([a-z]+)_)"))
+@patch("main.API_KEY_LOOKUP_SWEEP_ON_MISS", False)
+def test_fetch_api_key_filtered_miss_does_not_sweep(mock_get_api_gateway_client):
+    api_gateway_client_paginator = Mock()
+    api_gateway_client_paginator.paginate.return_value = [{"items": []}]
+
+    api_gateway_client = Mock()
+    api_gateway_client.get_paginator.return_value = api_gateway_client_paginator
+
+    mock_get_api_gateway_client.return_value = api_gateway_client
+
+    api_key = fetch_api_key("acme_hello")
+
+    assert api_key is None
+    api_gateway_client_paginator.paginate.assert_called_once()
+
+
+# find_api_key_lookup_filter
+@patch("main.api_key_lookup_strategy", parse_api_key_lookup_strategy(""))
+def test_find_api_key_lookup_filter_disabled():
+    assert find_api_key_lookup_filter("acme_hello") is None
+
+
+@patch("main.api_key_lookup_strategy", parse_api_key_lookup_strategy("nameQuery:regex(^([a-z]+)_)"))
+def test_find_api_key_lookup_filter_no_match():
+    assert find_api_key_lookup_filter("HELLO") is None
+
+
+@patch("main.api_key_lookup_strategy", parse_api_key_lookup_strategy("nameQuery:regex(^[a-z]+(?=_))"))
+def test_find_api_key_lookup_filter_whole_match():
+    assert find_api_key_lookup_filter("acme_hello") == {"nameQuery": "acme"}
+
+
+@patch("main.api_key_lookup_strategy", parse_api_key_lookup_strategy("unknown:regex(.*)"))
+def test_find_api_key_lookup_filter_unrecognized():
+    assert find_api_key_lookup_filter("acme_hello") is None
+
+
+# parse_api_key_lookup_strategy
+def test_parse_api_key_lookup_strategy_invalid_pattern():
+    assert parse_api_key_lookup_strategy("nameQuery:regex(([a-z]+)") is None
+
+
+@patch("main.get_api_gateway_client")
+@patch("main.api_key_lookup_strategy", parse_api_key_lookup_strategy("nameQuery:regex(([a-z]+)"))
+def test_fetch_api_key_invalid_lookup_strategy_sweeps(mock_get_api_gateway_client):
+    api_gateway_client_paginator = Mock()
+    api_gateway_client_paginator.paginate.return_value = [{
+        "items": [
+            {
+                "id": "b",
+                "value": "acme_hello"
+            }
+        ]
+    }]
+
+    api_gateway_client = Mock()
+    api_gateway_client.get_paginator.return_value = api_gateway_client_paginator
+
+    mock_get_api_gateway_client.return_value = api_gateway_client
+
+    api_key = fetch_api_key("acme_hello")
+
+    assert api_key["id"] == "b"
+    api_gateway_client_paginator.paginate.assert_called_once_with(
+        includeValues=True,
+        PaginationConfig={
+            'PageSize': 500
+        })
+
+
 # find_first_header_value
 def test_find_first_header_value_absent():
     first_header_value = find_first_header_value({"headers": {"foo": "bar"}}, "hello")